@@ -1,23 +1,43 @@
 import time
 import enum
 import struct
+import binascii
 import json
 import zmq
 import logging
 import argparse
 import serial
-import itertools
 import threading
 import queue
 
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+
+    def loads(data):
+        return json.loads(bytes(data))
+
 logger = logging.getLogger("simple-client")
 
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+# High-water mark for both sockets; the frames are small, so allow a
+# deep queue before ZMQ starts dropping during bursts.
+HWM = 10_000
 
-RQ_FORMAT = "<BBIhhhhhhhhhff"
-RQ_SIZE = struct.calcsize(RQ_FORMAT)
 
-RQ_STATE_FORMAT = "<BBIBBhhhh"
-RQ_STATE_SIZE = struct.calcsize(RQ_STATE_FORMAT)
+_RQ = struct.Struct("<BBIhhhhhhhhhff")
+RQ_SIZE = _RQ.size
+
+_RQ_STATE = struct.Struct("<BBIBBhhhh")
+RQ_STATE_SIZE = _RQ_STATE.size
+
+# Outgoing IMU record: mcu timestamp (double), raw timestamp (u32), then
+# for each of set A and B: acc x/y/z, gyr x/y/z, mag x/y/z as i16,
+# followed by pressure and temperature as f32.
+_OUT = struct.Struct("<dIhhhhhhhhhffhhhhhhhhhff")
 
 
 class PacketType(enum.Enum):
@@ -56,6 +76,8 @@ def ina3221_voltage(v):
 
 class SerialSocket:
 
+    __slots__ = ("_conn", "_q")
+
     def __init__(self, port):
         self._conn = serial.Serial(port=port, baudrate=115200)
         self._q = queue.Queue()
@@ -64,31 +86,79 @@ class SerialSocket:
         t.start()
 
     def _reader(self):
+        buf = bytearray()
+        put = self._q.put
         while True:
-            line = self._conn.readline()
-            if line.startswith(b"###"):
-                data = list(bytes.fromhex(line[3:-2].decode("ascii")))
-                j = json.dumps(dict(node="RQB", data=data))
-                self._q.put(j)
+            buf += self._conn.read(self._conn.in_waiting or 1)
+            start = 0
+            batch = []
+            while True:
+                end = buf.find(b"\n", start)
+                if end == -1:
+                    break
+                if buf.startswith(b"###", start):
+                    batch.append(("RQB", binascii.unhexlify(buf[start + 3:end - 1])))
+                start = end + 1
+            if start:
+                del buf[:start]
+            if batch:
+                put(batch)
+
+    def recv_batch(self):
+        return self._q.get()
+
+
+class ZMQSocket:
+
+    __slots__ = ("_socket", "_q")
+
+    def __init__(self, context, port):
+        self._socket = context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self._socket.setsockopt(zmq.RCVHWM, HWM)
+        self._socket.connect(port)
+        # Bounded so a slow consumer backpressures the reader instead of
+        # growing Python-side memory past the socket's HWM.
+        self._q = queue.Queue(maxsize=1024)
+        t = threading.Thread(target=self._reader)
+        t.daemon = True
+        t.start()
 
-    def recv(self):
+    def _reader(self):
+        socket = self._socket
+        put = self._q.put
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        while True:
+            poller.poll()
+            batch = []
+            while True:
+                try:
+                    batch.append(socket.recv(zmq.NOBLOCK, copy=False).buffer)
+                except zmq.Again:
+                    break
+            put(batch)
+
+    def recv_batch(self):
         return self._q.get()
 
 
 class ClockTracker:
 
+    __slots__ = ("_inv_clockfreq", "_last_timestamp", "_last_host", "_last_seq", "_mcu_time")
+
     def __init__(self, clockfreq=200_000_000):
-        self._clockfreq = clockfreq
+        self._inv_clockfreq = 1.0 / clockfreq
         self._last_timestamp = None
         self._last_host = None
         self._last_seq = None
         self._mcu_time = time.monotonic()
 
     def feed(self, now, timestamp, seq):
-        if self._last_timestamp is not None:
-            seq_diff = (seq + 2**8 - self._last_seq) % 2**8
-            diff = (timestamp + 2**32 - self._last_timestamp) % 2**32  / seq_diff / self._clockfreq
-            self._mcu_time += diff
+        last_timestamp = self._last_timestamp
+        if last_timestamp is not None:
+            seq_diff = (seq - self._last_seq) & 0xFF
+            self._mcu_time += ((timestamp - last_timestamp) & 0xFFFFFFFF) * self._inv_clockfreq / seq_diff
 
         self._last_timestamp = timestamp
         self._last_host = now
@@ -98,6 +168,8 @@ class ClockTracker:
 
 class MessageBuilder:
 
+    __slots__ = ("_clock_tracker", "_node", "_a", "_b", "_context", "_socket", "_debug", "_info", "_handlers", "_track", "_send")
+
     def __init__(self, node, context, port=9872):
         self._clock_tracker = ClockTracker()
         self._node = node
@@ -105,58 +177,70 @@ class MessageBuilder:
         self._b = None
         self._context = context
         self._socket = self._context.socket(zmq.PUB)
+        self._socket.setsockopt(zmq.SNDHWM, HWM)
+        self._socket.setsockopt(zmq.LINGER, 0)
         self._socket.bind("tcp://0.0.0.0:{}".format(port))
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+        self._info = logger.isEnabledFor(logging.INFO)
+        self._handlers = {
+            PacketType.STATE_PACKET.value: self._handle_state,
+            PacketType.IMU_SET_A_PACKET.value: self._handle_imu_a,
+            PacketType.IMU_SET_B_PACKET.value: self._handle_imu_b,
+        }
+        self._track = self._clock_tracker.feed
+        self._send = self._socket.send
 
     def feed(self, now, node, data):
-        seq, packet_type = data[:2]
-        packet_type = PacketType(packet_type)
-        match packet_type:
-            case PacketType.STATE_PACKET:
-                logger.debug("STATE PACKET")
-                logging.debug(data)
-                values = struct.unpack(RQ_STATE_FORMAT, data[:RQ_STATE_SIZE])
-                logger.info(IgnitionState(values[3]))
-                logger.info(ControlState(values[4]))
-                logger.info(ina226_voltage(values[5]))
-                logger.info(ina3221_voltage(values[6]))
-                logger.info(ina3221_voltage(values[7]))
-                logger.info(ina3221_voltage(values[8]))
-
-            case PacketType.IMU_SET_A_PACKET:
-                logger.debug("IMU_SET_A_PACKET")
-                values = struct.unpack(RQ_FORMAT, data[:RQ_SIZE])
-                self._feed_imu_messages(now, node, *values)
-            case PacketType.IMU_SET_B_PACKET:
-                logger.debug("IMU_SET_B_PACKET")
-                logging.debug(data[:RQ_SIZE])
-                values = struct.unpack(RQ_FORMAT, data[:RQ_SIZE])
-                self._feed_imu_messages(now, node, *values)
-
-    def _feed_imu_messages(self, now, node, seq, packet_type, timestamp, acc_x, acc_y, acc_z, gyr_x, gyr_y, gyr_z, mag_x, mag_y, mag_z, pressure, temperature):
-        mcu_timestamp = self._clock_tracker.feed(now, timestamp, seq)
+        # data can be any buffer object (bytes, bytearray, memoryview);
+        # indexing and unpack_from read it in place without copying.
+        handler = self._handlers.get(data[1])
+        if handler is not None:
+            handler(now, node, data)
+
+    def _handle_state(self, now, node, data):
+        if self._debug:
+            logger.debug("STATE PACKET")
+            logger.debug(bytes(data))
+        if self._info:
+            values = _RQ_STATE.unpack_from(data, 0)
+            logger.info(IgnitionState(values[3]))
+            logger.info(ControlState(values[4]))
+            logger.info(ina226_voltage(values[5]))
+            logger.info(ina3221_voltage(values[6]))
+            logger.info(ina3221_voltage(values[7]))
+            logger.info(ina3221_voltage(values[8]))
+
+    def _handle_imu_a(self, now, node, data):
+        if self._debug:
+            logger.debug("IMU_SET_A_PACKET")
+        values = _RQ.unpack_from(data, 0)
         if node == self._node:
-            data = dict(
-                acc=dict(x=acc_x, y=acc_y, z=acc_z),
-                gyr=dict(x=gyr_x, y=gyr_y, z=gyr_z),
-                mag=dict(x=mag_x, y=mag_y, z=mag_z),
-                temperature=temperature,
-                pressure=pressure,
-            )
-            packet_type = PacketType(packet_type)
-            match packet_type:
-                case PacketType.IMU_SET_A_PACKET:
-                    self._a = data
-                case PacketType.IMU_SET_B_PACKET:
-                    self._b = data
-            if self._a is not None and self._b is not None:
-                message = json.dumps(dict(timestamp=mcu_timestamp, raw_timestamp=timestamp, a=self._a, b=self._b))
-                logging.debug(f"message: {repr(message)}")
-                self._socket.send_string(message)
+            self._a = values[3:]
+        self._feed_imu_messages(now, node, values)
+
+    def _handle_imu_b(self, now, node, data):
+        if self._debug:
+            logger.debug("IMU_SET_B_PACKET")
+            logger.debug(bytes(data[:RQ_SIZE]))
+        values = _RQ.unpack_from(data, 0)
+        if node == self._node:
+            self._b = values[3:]
+        self._feed_imu_messages(now, node, values)
+
+    def _feed_imu_messages(self, now, node, values):
+        seq, timestamp = values[0], values[2]
+        mcu_timestamp = self._track(now, timestamp, seq)
+        if node == self._node and self._a is not None and self._b is not None:
+            message = _OUT.pack(mcu_timestamp, timestamp, *self._a, *self._b)
+            if self._debug:
+                logger.debug(f"message: {repr(message)}")
+            self._send(message, copy=False)
+            self._a = self._b = None
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--loglevel", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    parser.add_argument("--loglevel", choices=LOG_LEVELS, default="INFO")
     parser.add_argument("--serial", help="If given a serial port, use that")
     parser.add_argument("--port", default="tcp://novaview.local:2424")
     parser.add_argument("--count", type=int, help="Only consume count messages. All if not given.")
@@ -164,33 +248,73 @@ def parse_args():
     return parser.parse_args()
 
 
+def run_serial(socket, builder, count):
+    monotonic = time.monotonic
+    feed = builder.feed
+    recv_batch = socket.recv_batch
+
+    def process(batch):
+        now = monotonic()
+        for node, data in batch:
+            feed(now, node, data)
+
+    if count is None:
+        while True:
+            process(recv_batch())
+    processed = 0
+    while processed < count:
+        batch = recv_batch()[:count - processed]
+        process(batch)
+        processed += len(batch)
+
+
+def run_zmq(socket, builder, count):
+    parse = loads
+    monotonic = time.monotonic
+    feed = builder.feed
+    recv_batch = socket.recv_batch
+    debug = logger.isEnabledFor(logging.DEBUG)
+    previous = None
+
+    def process(batch):
+        nonlocal previous
+        now = monotonic()
+        for incoming in batch:
+            # The PUB side occasionally re-sends a frame; drop exact
+            # repeats before paying for the parse.
+            if incoming == previous:
+                continue
+            previous = incoming
+            if debug:
+                logger.debug("incoming: %s", bytes(incoming))
+            try:
+                msg = parse(incoming)
+            except ValueError:
+                logger.error("Can't parse incoming")
+            else:
+                feed(now, msg["node"], bytes(msg["data"]))
+
+    if count is None:
+        while True:
+            process(recv_batch())
+    processed = 0
+    while processed < count:
+        batch = recv_batch()[:count - processed]
+        process(batch)
+        processed += len(batch)
+
+
 def main():
-    context = zmq.Context()
+    context = zmq.Context.instance()
     args = parse_args()
     logging.basicConfig(
         level=getattr(logging, args.loglevel)
     )
+    builder = MessageBuilder(args.node, context)
     if args.serial:
-        socket = SerialSocket(args.serial)
+        run_serial(SerialSocket(args.serial), builder, args.count)
     else:
-        socket = context.socket(zmq.SUB)
-        socket.setsockopt(zmq.SUBSCRIBE, b'')
-        socket.connect(args.port)
-    builder = MessageBuilder(args.node, context)
-
-    for step in itertools.count():
-        if args.count is not None and args.count <= step:
-            break
-        incoming = socket.recv()
-        logging.debug("incoming: %s", incoming)
-        try:
-            msg = json.loads(incoming)
-        except ValueError:
-            logging.error("Can't parse incoming")
-        else:
-            now = time.monotonic()
-            node, data = msg["node"], bytes(msg["data"])
-            builder.feed(now, node, data)
+        run_zmq(ZMQSocket(context, args.port), builder, args.count)
 
 
 if __name__ == '__main__':